@@ -7,25 +7,33 @@ python download-model.py facebook/opt-1.3b
 '''
 
 import argparse
-import base64
 import datetime
+import errno
 import hashlib
-import json
+import mmap
 import os
 import re
+import shutil
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
 import requests
 import tqdm
+from requests.adapters import HTTPAdapter
 from tqdm.contrib.concurrent import thread_map
+from urllib3.util.retry import Retry
 
 parser = argparse.ArgumentParser()
 parser.add_argument('MODEL', type=str, default=None, nargs='?')
 parser.add_argument('--branch', type=str, default='main',
                     help='Name of the Git branch to download from.')
-parser.add_argument('--threads', type=int, default=1,
+parser.add_argument('--threads', type=int, default=min(8, os.cpu_count() or 4),
                     help='Number of files to download simultaneously.')
+parser.add_argument('--chunks-per-file', type=int, default=4,
+                    help='Number of byte ranges to download simultaneously for each large file. '
+                         'Not used with --check.')
 parser.add_argument('--text-only', action='store_true',
                     help='Only download text files (txt/json).')
 parser.add_argument('--output', type=str, default=None,
@@ -33,41 +41,217 @@ parser.add_argument('--output', type=str, default=None,
 parser.add_argument('--clean', action='store_true',
                     help='Does not resume the previous download.')
 parser.add_argument('--check', action='store_true',
-                    help='Validates the checksums of model files.')
+                    help='Validates the checksums of model files. Files are then downloaded in a single '
+                         'stream each, so that they are hashed as they arrive instead of read back from disk.')
+parser.add_argument('--git', action='store_true',
+                    help='Clones the repo with git instead of downloading the files.')
 parser.add_argument('--scrap', action='store_true',
-                    help='Scraps the repo instead of cloning the files.')
+                    help='Scraps the repo instead of cloning the files (now the default).')
 args = parser.parse_args()
 
-
-def get_file(url, output_folder):
+# A single session keeps the connections to huggingface.co alive across
+# the listing, the size probes and the downloads of every file. The pool
+# holds one connection per byte range of every file downloaded at once.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=args.threads,
+    pool_maxsize=args.threads * max(args.chunks_per_file, 1),
+    max_retries=Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504])))
+SESSION.headers.update({'User-Agent': 'fastchat-download-model',
+                        'Accept-Encoding': 'identity'})
+
+_RE_BRANCH = re.compile(r"^[a-zA-Z0-9._-]+$")
+_RE_PYTORCH = re.compile(r"(pytorch|adapter)_model.*\.bin")
+_RE_SAFETENSORS = re.compile(r".*\.safetensors")
+_RE_PT = re.compile(r".*\.pt")
+_RE_GGML = re.compile(r"ggml.*\.bin")
+_RE_TOKENIZER = re.compile(r"tokenizer.*\.model")
+
+# Size of the reads from the network and of the writes to disk.
+BLOCK_SIZE = 1 << 20
+
+# Files smaller than two chunks of this size are downloaded in one stream.
+MIN_CHUNK_SIZE = 1 << 24
+
+# Upper bound on the byte ranges of a file, which is also the most that
+# each connection has to download again after an interrupted run.
+MAX_RANGE_SIZE = 1 << 26
+
+
+def get_file_chunk(url, fd, start, end, update, stop, fallback_url=None):
+    """Writes bytes `start` to `end` of `url` into `fd` and returns whether
+    the range was completed, which is not the case when `stop` was set."""
+    headers = {'Range': f'bytes={start}-{end}'}
+    r = SESSION.get(url, stream=True, headers=headers)
+    if r.status_code == 403 and fallback_url is not None:
+        # Resolved CDN links are signed and can expire during a long
+        # download, in which case the range goes through the redirect again
+        r.close()
+        r = SESSION.get(fallback_url, stream=True, headers=headers)
+    with r:
+        if r.status_code != 206:
+            raise RuntimeError(
+                f"Expected a partial response for {url}, got HTTP {r.status_code}.")
+        offset = start
+        while not stop.is_set():
+            data = r.raw.read(BLOCK_SIZE)
+            if not data:
+                break
+            os.pwrite(fd, data, offset)
+            offset += len(data)
+            update(len(data))
+    if stop.is_set():
+        return False
+    if offset != end + 1:
+        raise RuntimeError(
+            f"Incomplete download of bytes {start}-{end} of {url}.")
+    return True
+
+
+def preallocate(fd, size):
+    # Reserve the blocks up front so the file is laid out contiguously, and
+    # fall back to a sparse file where the platform or filesystem can't
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+    os.ftruncate(fd, size)
+
+
+def get_file_chunked(url, resolved_url, output_path, total_size, num_chunks, update):
+    # Write to a temporary file so that an interrupted download is not
+    # mistaken for a complete one by the resume check in get_file, and log
+    # every finished range next to it so that the next run can resume.
+    # Ranges are requested from `resolved_url`, where the HEAD request was
+    # redirected, so that they don't each hit the Hub for the redirect
+    part_path = output_path.with_name(output_path.name + '.part')
+    done_path = output_path.with_name(output_path.name + '.part.done')
+    range_size = min(MAX_RANGE_SIZE, -(-total_size // num_chunks))
+    ranges = [(start, min(start + range_size, total_size) - 1)
+              for start in range(0, total_size, range_size)]
+
+    done = set()
+    if not args.clean and done_path.exists() and part_path.exists() \
+            and part_path.stat().st_size == total_size:
+        with open(done_path) as f:
+            # A line cut short by an interrupted write is not trusted
+            done = {tuple(map(int, line.split('-'))) for line in f if line.endswith('\n')}
+        log = open(done_path, 'a')
+        fd = os.open(part_path, os.O_WRONLY)
+    else:
+        # Empty the log before the .part, which is then back to its full size
+        log = open(done_path, 'w')
+        fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC)
+    update(sum(end - start + 1 for start, end in ranges if (start, end) in done))
+
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def fetch(start, end):
+        if get_file_chunk(resolved_url, fd, start, end, update, stop, fallback_url=url):
+            with lock:
+                log.write(f'{start}-{end}\n')
+                log.flush()
+
+    try:
+        if not done:
+            preallocate(fd, total_size)
+        with ThreadPoolExecutor(max_workers=num_chunks) as executor:
+            futures = [executor.submit(fetch, start, end)
+                       for start, end in ranges if (start, end) not in done]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                # Stop the other ranges instead of waiting for them to finish
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    finally:
+        os.close(fd)
+        log.close()
+    os.replace(part_path, output_path)
+    done_path.unlink()
+
+
+class ProgressWriter:
+    """Reports every block written through to the file, and hashes it if asked."""
+
+    def __init__(self, f, update, h=None):
+        self.f = f
+        self.update = update
+        self.h = h
+
+    def write(self, data):
+        if self.h is not None:
+            self.h.update(data)
+        self.update(len(data))
+        return self.f.write(data)
+
+
+def get_file(url, output_folder, head, update):
+    """Downloads a file and returns its SHA256 if it was hashed while streaming.
+
+    `head` is the response of the HEAD request for `url` and `update` is
+    called with the number of bytes of the file that are on disk."""
     filename = Path(url.rsplit('/', 1)[1])
     output_path = output_folder / filename
+    total_size = int(head.headers.get('content-length', 0))
+    h = hashlib.sha256() if args.check else None
     if output_path.exists() and not args.clean:
         # Check if the file has already been downloaded completely
-        r = requests.get(url, stream=True)
-        total_size = int(r.headers.get('content-length', 0))
-        if output_path.stat().st_size >= total_size:
-            return
+        have = output_path.stat().st_size
+        if have >= total_size:
+            update(total_size)
+            return None
         # Otherwise, resume the download from where it left off
-        headers = {'Range': f'bytes={output_path.stat().st_size}-'}
+        if h is not None and have > 0:
+            with open(output_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                h.update(mm)
+        update(have)
+        headers = {'Range': f'bytes={have}-'}
         mode = 'ab'
     else:
+        # Large files are split into byte ranges fetched over separate
+        # connections, unless they are hashed while streaming for --check.
+        # An interrupted ranged download is still resumed as one, since its
+        # bytes live in the .part file until it completes
+        part_path = output_path.with_name(output_path.name + '.part')
+        done_path = output_path.with_name(output_path.name + '.part.done')
+        num_chunks = min(args.chunks_per_file, total_size // MIN_CHUNK_SIZE)
+        if (h is None or (part_path.exists() and not args.clean)) and num_chunks > 1 \
+                and head.headers.get('accept-ranges') == 'bytes' and hasattr(os, 'pwrite'):
+            get_file_chunked(url, head.url, output_path, total_size, num_chunks, update)
+            return None
+        # The file is downloaded in one stream, so a ranged download left
+        # behind by an earlier run won't be resumed
+        for path in (part_path, done_path):
+            if path.exists():
+                path.unlink()
         headers = {}
         mode = 'wb'
 
-    r = requests.get(url, stream=True, headers=headers)
+    r = SESSION.get(url, stream=True, headers=headers)
+    r.raise_for_status()
+    if mode == 'ab' and r.status_code != 206:
+        # The server ignored the range and is sending the whole file
+        mode = 'wb'
+        update(-have)
+        if h is not None:
+            h = hashlib.sha256()
+    r.raw.decode_content = True
     with open(output_path, mode) as f:
-        total_size = int(r.headers.get('content-length', 0))
-        block_size = 1024
-        with tqdm.tqdm(total=total_size, unit='iB', unit_scale=True, bar_format='{l_bar}{bar}| {n_fmt:6}/{total_fmt:6} {rate_fmt:6}') as t:
-            for data in r.iter_content(block_size):
-                t.update(len(data))
-                f.write(data)
+        shutil.copyfileobj(r.raw, ProgressWriter(f, update, h), length=BLOCK_SIZE)
+
+    return h.hexdigest() if h is not None else None
 
 
 def sanitize_branch_name(branch_name):
-    pattern = re.compile(r"^[a-zA-Z0-9._-]+$")
-    if pattern.match(branch_name):
+    if _RE_BRANCH.match(branch_name):
         return branch_name
     else:
         raise ValueError(
@@ -125,9 +309,14 @@ EleutherAI/pythia-1.4b-deduped
 
 def get_download_links_from_huggingface(model, branch):
     base = "https://huggingface.co"
-    # page = f"/{model}/tree/{branch}?cursor="
-    # cursor = b""
-    page = f"/{model}/tree/{branch}"
+    url = f"{base}/api/models/{model}/tree/{branch}"
+    entries = []
+    while url:
+        r = SESSION.get(url)
+        r.raise_for_status()
+        entries.extend(r.json())
+        # Long listings are paged, with the next page in the Link header
+        url = r.links.get('next', {}).get('url')
 
     links = []
     sha256 = []
@@ -137,85 +326,124 @@ def get_download_links_from_huggingface(model, branch):
     has_ggml = False
     has_safetensors = False
     is_lora = False
-    while True:
-        # content = requests.get(f"{base}{page}{cursor.decode()}").content
-        print(f"{base}{page}")
-        r = requests.get(f"{base}{page}")
-        _content = r.content
-        # DEBUG: dump content
-        with open("content.html", "wb") as f:
-            import os
-            print("pwd", os.getcwd())
-            f.write(_content)
-
-        # dict = json.loads(content) # BUG: json.decoder.JSONDecodeError: Expecting value: line 1 column 1 (char 0)
-        # dict = json.loads(content.decode())
-        # still the same bug
-        dict = json.loads(_content.decode('utf-8'))
-
-        if len(dict) == 0:
-            break
-
-        for i in range(len(dict)):
-            fname = dict[i]['path']
-            if not is_lora and fname.endswith(('adapter_config.json', 'adapter_model.bin')):
-                is_lora = True
-
-            is_pytorch = re.match("(pytorch|adapter)_model.*\.bin", fname)
-            is_safetensors = re.match(".*\.safetensors", fname)
-            is_pt = re.match(".*\.pt", fname)
-            is_ggml = re.match("ggml.*\.bin", fname)
-            is_tokenizer = re.match("tokenizer.*\.model", fname)
-            is_text = re.match(".*\.(txt|json|py|md)", fname) or is_tokenizer
-
-            if any((is_pytorch, is_safetensors, is_pt, is_tokenizer, is_text)):
-                if 'lfs' in dict[i]:
-                    sha256.append([fname, dict[i]['lfs']['oid']])
-                if is_text:
-                    links.append(
-                        f"https://huggingface.co/{model}/resolve/{branch}/{fname}")
-                    classifications.append('text')
-                    continue
-                if not args.text_only:
-                    links.append(
-                        f"https://huggingface.co/{model}/resolve/{branch}/{fname}")
-                    if is_safetensors:
-                        has_safetensors = True
-                        classifications.append('safetensors')
-                    elif is_pytorch:
-                        has_pytorch = True
-                        classifications.append('pytorch')
-                    elif is_pt:
-                        has_pt = True
-                        classifications.append('pt')
-                    elif is_ggml:
-                        has_ggml = True
-                        classifications.append('ggml')
-
-        cursor = base64.b64encode(
-            f'{{"file_name":"{dict[-1]["path"]}"}}'.encode()) + b':50'
-        cursor = base64.b64encode(cursor)
-        cursor = cursor.replace(b'=', b'%3D')
+    for entry in entries:
+        if entry.get('type') == 'directory':
+            continue
+        fname = entry['path']
+        if not is_lora and fname.endswith(('adapter_config.json', 'adapter_model.bin')):
+            is_lora = True
+
+        is_pytorch = _RE_PYTORCH.match(fname)
+        is_safetensors = _RE_SAFETENSORS.match(fname)
+        is_pt = _RE_PT.match(fname)
+        is_ggml = _RE_GGML.match(fname)
+        is_tokenizer = _RE_TOKENIZER.match(fname)
+        is_text = fname.endswith(('.txt', '.json', '.py', '.md')) or is_tokenizer
+
+        if any((is_pytorch, is_safetensors, is_pt, is_tokenizer, is_text)):
+            # Kept aligned with links so that the oids of the files that are
+            # not downloaded are dropped along with them
+            checksum = [fname, entry['lfs']['oid']] if 'lfs' in entry else None
+            if is_text:
+                links.append(
+                    f"https://huggingface.co/{model}/resolve/{branch}/{fname}")
+                sha256.append(checksum)
+                classifications.append('text')
+                continue
+            if not args.text_only:
+                links.append(
+                    f"https://huggingface.co/{model}/resolve/{branch}/{fname}")
+                sha256.append(checksum)
+                if is_safetensors:
+                    has_safetensors = True
+                    classifications.append('safetensors')
+                elif is_pytorch:
+                    has_pytorch = True
+                    classifications.append('pytorch')
+                elif is_pt:
+                    has_pt = True
+                    classifications.append('pt')
+                elif is_ggml:
+                    has_ggml = True
+                    classifications.append('ggml')
 
     # If both pytorch and safetensors are available, download safetensors only
     if (has_pytorch or has_pt) and has_safetensors:
-        for i in range(len(classifications)-1, -1, -1):
-            if classifications[i] in ['pytorch', 'pt']:
-                links.pop(i)
+        keep = [c not in ('pytorch', 'pt') for c in classifications]
+        links = [link for link, k in zip(links, keep) if k]
+        sha256 = [checksum for checksum, k in zip(sha256, keep) if k]
+        classifications = [c for c, k in zip(classifications, keep) if k]
 
+    sha256 = [checksum for checksum in sha256 if checksum is not None]
     return links, sha256, is_lora
 
 
 def download_files(file_list, output_folder, num_threads=8):
-    thread_map(lambda url: get_file(url, output_folder),
-               file_list, max_workers=num_threads, disable=True)
+    # Probe every file first so that a single bar tracks the bytes of all of them
+    heads = thread_map(lambda url: SESSION.head(url, allow_redirects=True),
+                       file_list, max_workers=num_threads, disable=True)
+    total_size = sum(int(r.headers.get('content-length', 0)) for r in heads)
+    lock = threading.Lock()
+
+    with tqdm.tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024, bar_format='{l_bar}{bar}| {n_fmt:6}/{total_fmt:6} {rate_fmt:6}') as t:
+        def update(n):
+            with lock:
+                t.update(n)
+
+        digests = thread_map(lambda item: get_file(item[0], output_folder, item[1], update),
+                             list(zip(file_list, heads)), max_workers=num_threads, disable=True)
+    return {url.rsplit('/', 1)[1]: digest
+            for url, digest in zip(file_list, digests) if digest is not None}
+
+
+def verify(path, oid):
+    with open(path, 'rb') as f:
+        if hasattr(hashlib, 'file_digest'):
+            # Python 3.11+ hashes the file inside OpenSSL without holding the GIL
+            digest = hashlib.file_digest(f, 'sha256').hexdigest()
+        else:
+            h = hashlib.sha256()
+            # mmap can't map an empty file
+            if os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    h.update(mm)
+            digest = h.hexdigest()
+    return digest == oid
+
+
+def check_model_files(sha256, output_folder, num_threads=8, digests=None):
+    # Files hashed while they were downloaded are not read back from disk
+    digests = digests or {}
+
+    def check(entry):
+        fpath = output_folder / entry[0]
+        if not fpath.exists():
+            return None
+        if entry[0] in digests:
+            return digests[entry[0]] == entry[1]
+        return verify(fpath, entry[1])
+
+    results = thread_map(check, sha256, max_workers=num_threads, disable=True)
+    validated = True
+    for (fname, _), result in zip(sha256, results):
+        if result is None:
+            print(f"The following file is missing: {output_folder / fname}")
+            validated = False
+        elif not result:
+            print(f"Checksum failed: {fname}")
+            validated = False
+        else:
+            print(f"Checksum validated: {fname}")
+
+    if validated:
+        print('[+] Validated checksums of all model files!')
+    else:
+        print('[-] Invalid checksums. Rerun download-model.py with the --clean flag.')
 
 
 if __name__ == '__main__':
     model = args.MODEL
     branch = args.branch
-    print("scrap:", args.scrap, "\n")
-
     if model is None:
         model, branch = select_model_from_default_options()
     else:
@@ -231,13 +459,8 @@ if __name__ == '__main__':
                 print(f"Error: {err_branch}")
                 sys.exit()
 
-    if args.scrap:
-        links, sha256, is_lora = get_download_links_from_huggingface(
-            model, branch)
-    else:
-        links = []
-        sha256 = []
-        is_lora = False
+    links, sha256, is_lora = get_download_links_from_huggingface(
+        model, branch)
 
     if args.output is not None:
         base_folder = args.output
@@ -249,25 +472,27 @@ if __name__ == '__main__':
         output_folder += f'_{branch}'
     output_folder = Path(base_folder) / output_folder
 
+    # Creating the folder
+    output_folder.mkdir(parents=True, exist_ok=True)
+
     # Downloading the files
     print(f"Downloading the model to {output_folder}")
-    if args.scrap:
-        download_files(links, output_folder, args.threads)
-    else:
+    digests = {}
+    if args.git:
+        # For example: git clone https://huggingface.co/anon8231489123/vicuna-13b-GPTQ-4bit-128g to desired output folder
         _cmd = f"git clone https://huggingface.co/{model} {output_folder}"
         print(
             f"Cloning the model to {output_folder} using the command: {_cmd}")
         os.system(_cmd)
+    else:
+        digests = download_files(links, output_folder, args.threads)
 
-        # For example: git clone https://huggingface.co/anon8231489123/vicuna-13b-GPTQ-4bit-128g to desired output folder
-
-
-    # Creating the folder and writing the metadata
-    if not output_folder.exists():
-        output_folder.mkdir()
-
+    # Writing the metadata
     with open(output_folder / 'huggingface-metadata.txt', 'w') as f:
         f.write(f'url: https://huggingface.co/{model}\n')
         f.write(f'branch: {branch}\n')
         f.write(
             f'download date: {str(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))}\n')
+
+    if args.check:
+        check_model_files(sha256, output_folder, args.threads, digests)